@@ -16,13 +16,20 @@ queue_gui.py  ―  受付システム Tkinter クライアント
 from __future__ import annotations
 
 import argparse
+import json
 import threading
 import tkinter as tk
+from concurrent.futures import ThreadPoolExecutor
 from tkinter import messagebox, ttk
 from typing import Any, Dict, List, Optional
 
 import requests
 
+try:
+    import websocket  # websocket-client（無ければ REST ポーリングにフォールバック）
+except ImportError:
+    websocket = None
+
 API_BASE = "http://localhost:8000"
 ADMIN_API_KEY = "CHANGE_ME"  # queue_server.py と合わせる
 
@@ -33,6 +40,14 @@ ADMIN_API_KEY = "CHANGE_ME"  # queue_server.py と合わせる
 class ApiClient:
     def __init__(self, base: str = API_BASE):
         self.base = base.rstrip("/")
+        # keep-alive 接続を使い回す（ポーリングごとの TCP 接続確立を省く）
+        self.s = requests.Session()
+        self.s.headers.update({"Connection": "keep-alive"})
+        adapter = requests.adapters.HTTPAdapter(pool_connections=4, pool_maxsize=8)
+        self.s.mount("http://", adapter)
+        # ETag 対応エンドポイント用（304 なら前回ボディを使い回す）
+        self._etags: Dict[str, str] = {}
+        self._etag_body: Dict[str, Any] = {}
 
     # ---------- Service ----------
     def get_services(self) -> List[Dict[str, Any]]:
@@ -59,40 +74,95 @@ class ApiClient:
         return self._get("/stats")
 
     # ---------- Admin ----------
+    def snapshot(self):
+        return self._get("/admin/snapshot",
+                         headers={"x-api-key": ADMIN_API_KEY})
+
     def call_next(self, service_id: int):
         return self._post(f"/admin/next/{service_id}",
                           headers={"x-api-key": ADMIN_API_KEY})
 
     # ---------- 内部 ----------
     def _get(self, path, **kw):
-        r = requests.get(self.base + path, timeout=5, **kw)
+        headers = dict(kw.pop("headers", None) or {})
+        if path in self._etags:
+            headers["If-None-Match"] = self._etags[path]
+        r = self.s.get(self.base + path, timeout=5, headers=headers, **kw)
+        if r.status_code == 304:
+            return self._etag_body[path]
         r.raise_for_status()
+        if "ETag" in r.headers:
+            self._etags[path] = r.headers["ETag"]
+            self._etag_body[path] = r.json()
+            return self._etag_body[path]
         return r.json()
 
     def _post(self, path, **kw):
-        r = requests.post(self.base + path, timeout=5, **kw)
+        r = self.s.post(self.base + path, timeout=5, **kw)
         r.raise_for_status()
         return r.json()
 
     def _delete(self, path, **kw):
-        r = requests.delete(self.base + path, timeout=5, **kw)
+        r = self.s.delete(self.base + path, timeout=5, **kw)
         r.raise_for_status()
 
 
+# ───────────────────────────────────────────────
+# WebSocket 購読
+# ───────────────────────────────────────────────
+class WsClient:
+    """/ws/queues/{service_id} を購読し、更新をコールバックへ渡す"""
+
+    def __init__(self, base: str, service_id: int, on_update, on_disconnect):
+        ws_base = base.replace("http://", "ws://", 1).replace("https://", "wss://", 1)
+        self.on_update = on_update
+        self.on_disconnect = on_disconnect
+        self.closed = False
+        self.app = websocket.WebSocketApp(
+            f"{ws_base}/ws/queues/{service_id}",
+            on_message=self._on_message,
+            on_error=self._on_closed,
+            on_close=self._on_closed,
+        )
+        threading.Thread(target=self.app.run_forever, daemon=True).start()
+
+    def _on_message(self, _ws, message):
+        try:
+            self.on_update(json.loads(message))
+        except Exception:
+            pass
+
+    def _on_closed(self, _ws, *args):
+        if not self.closed:
+            self.closed = True
+            self.on_disconnect()
+
+    def close(self):
+        self.closed = True
+        try:
+            self.app.close()
+        except Exception:
+            pass
+
+
 # ───────────────────────────────────────────────
 # Tkinter 共通ユーティリティ
 # ───────────────────────────────────────────────
-def async_api(func):
-    """API 呼び出しを別スレッドで実行し、完了時に mainloop へ戻すデコレータ"""
-    def wrapper(self, *args, **kwargs):
-        def task():
-            try:
-                result = func(self, *args, **kwargs)
-                self.root.after(0, lambda: self._on_success(result))
-            except Exception as e:
-                self.root.after(0, lambda: self._on_error(e))
-        threading.Thread(target=task, daemon=True).start()
-    return wrapper
+_pool = ThreadPoolExecutor(max_workers=2)  # API 呼び出し用の共有プール
+
+
+def run_async(root, fn, on_done=None, on_error=None):
+    """API 呼び出しをプールで実行し、結果を mainloop へ戻す（UI を固めない）"""
+    def task():
+        try:
+            result = fn()
+        except Exception as e:
+            if on_error is not None:
+                root.after(0, lambda err=e: on_error(err))
+            return
+        if on_done is not None:
+            root.after(0, lambda r=result: on_done(r))
+    _pool.submit(task)
 
 
 # ───────────────────────────────────────────────
@@ -104,6 +174,8 @@ class ClientGUI:
         self.api = api
         self.root.title("受付 (Client)")
         self.ticket_id: Optional[int] = None
+        self.svc_dict: Dict[str, int] = {}
+        self._last_services_sig: Optional[tuple] = None
 
         # ----- UI 構築 -----
         frm_top = ttk.Frame(root, padding=10)
@@ -139,14 +211,18 @@ class ClientGUI:
 
     # ----- API -----
     def refresh_services(self):
-        try:
-            svcs = self.api.get_services()
+        def done(svcs):
+            sig = tuple((s["id"], s["name"]) for s in svcs)
+            if sig == self._last_services_sig:
+                return  # 変化がなければ Combobox を作り直さない
+            self._last_services_sig = sig
             self.svc_dict = {s["name"]: s["id"] for s in svcs}
             self.cmb["values"] = list(self.svc_dict.keys())
             if svcs:
                 self.cmb.current(0)
-        except Exception as e:
-            messagebox.showerror("Error", f"サービス取得失敗:\n{e}")
+
+        run_async(self.root, self.api.get_services, done,
+                  lambda e: messagebox.showerror("Error", f"サービス取得失敗:\n{e}"))
 
     def register(self):
         name = self.name_var.get().strip()
@@ -157,27 +233,34 @@ class ClientGUI:
         if svc_name not in self.svc_dict:
             messagebox.showwarning("入力不足", "サービスを選択してください")
             return
-        try:
-            res = self.api.register_ticket(name, self.svc_dict[svc_name])
+
+        def done(res):
             self.ticket_id = res["id"]
             self.msg_label["text"] = f"チケット発行: #{self.ticket_id}"
             self.btn_reg["state"] = "disabled"
             self.poll_ticket()
-        except Exception as e:
-            messagebox.showerror("Error", f"受付失敗:\n{e}")
+
+        run_async(self.root,
+                  lambda: self.api.register_ticket(name, self.svc_dict[svc_name]),
+                  done,
+                  lambda e: messagebox.showerror("Error", f"受付失敗:\n{e}"))
 
     def poll_ticket(self):
         if not self.ticket_id:
             return
-        try:
-            t = self.api.get_ticket(self.ticket_id)
+
+        def done(t):
             self.pos_var.set(str(t["position"]))
             if t["position"] == 0:
                 self.msg_label.config(text="呼び出しされました！", foreground="red")
                 return
-        except Exception as e:
+            self.root.after(3000, self.poll_ticket)
+
+        def fail(e):
             self.msg_label.config(text=f"更新エラー: {e}", foreground="orange")
-        self.root.after(3000, self.poll_ticket)
+            self.root.after(3000, self.poll_ticket)
+
+        run_async(self.root, lambda: self.api.get_ticket(self.ticket_id), done, fail)
 
 
 # ───────────────────────────────────────────────
@@ -218,21 +301,52 @@ class AdminGUI:
         self.txt.pack()
 
         self.services: List[Dict[str, Any]] = []
-        self.load_stats()
+        self._queues: Dict[int, Dict[str, Any]] = {}
+        self._ws: Optional[WsClient] = None
+        self._detail_service_id: Optional[int] = None
+        self._stats_job: Optional[str] = None
+        self._last_services_sig: Optional[tuple] = None
+        self.load_stats()  # 5 秒ごとの自動更新もここから始まる
         self.lst.bind("<<ListboxSelect>>", lambda _: self.show_detail())
-        self.root.after(5000, self.load_stats)  # 5 秒ごとに自動更新
 
     def load_stats(self):
-        try:
-            self.services = self.api.stats()
-            self.lst.delete(0, "end")
-            for s in self.services:
-                self.lst.insert("end",
-                                f"[{s['service_id']}] {s['service_name']} ({s['waiting']}人待ち)")
-        except Exception as e:
-            messagebox.showerror("Error", f"統計取得失敗:\n{e}")
-        finally:
-            self.root.after(5000, self.load_stats)
+        # 多重チェーンを防ぎつつ取得はプールに投げる（UI スレッドを塞がない）
+        if self._stats_job is not None:
+            self.root.after_cancel(self._stats_job)
+        run_async(self.root, self.api.snapshot,
+                  self._apply_stats,
+                  lambda e: messagebox.showerror("Error", f"統計取得失敗:\n{e}"))
+        self._stats_job = self.root.after(5000, self.load_stats)
+
+    def _apply_stats(self, snap: Dict[str, Any]):
+        # 統計と全キュー詳細を 1 リクエストで取得している
+        self.services = snap["services"]
+        self._queues = {int(k): v for k, v in snap["queues"].items()}
+        sig = tuple((s["service_id"], s["service_name"], s["waiting"])
+                    for s in self.services)
+        if sig != self._last_services_sig:  # 変化がなければ再描画しない
+            self._last_services_sig = sig
+            self._update_service_rows()
+        # 表示中の詳細もスナップショットから更新（WS 購読中は push に任せる）
+        if self._ws is None and self._detail_service_id in self._queues:
+            self._render_detail(self._queues[self._detail_service_id])
+
+    def _update_service_rows(self):
+        """変わった行だけ差し替え、再描画と選択リセットを最小限にする"""
+        rows = [f"[{s['service_id']}] {s['service_name']} ({s['waiting']}人待ち)"
+                for s in self.services]
+        current = self.lst.get(0, "end")
+        for i, text in enumerate(rows):
+            if i >= len(current):
+                self.lst.insert("end", text)
+            elif current[i] != text:
+                sel = self.lst.curselection()
+                self.lst.delete(i)
+                self.lst.insert(i, text)
+                if sel and sel[0] == i:
+                    self.lst.selection_set(i)
+        for i in range(len(current) - 1, len(rows) - 1, -1):
+            self.lst.delete(i)
 
     def selected_service_id(self) -> Optional[int]:
         sel = self.lst.curselection()
@@ -245,32 +359,63 @@ class AdminGUI:
         svc_id = self.selected_service_id()
         if svc_id is None:
             return
-        try:
-            q = self.api.queue_detail(svc_id)
-            self.txt.config(state="normal")
-            self.txt.delete("1.0", "end")
-            self.txt.insert("end", f"{q['service_name']}  待ち: {q['waiting']}人\n\n")
-            for t in q["tickets"]:
-                self.txt.insert("end",
-                                f"#{t['id']:04d} {t['name']:<12} Pos:{t['position']} "
-                                f"{'呼出済' if t['called'] else ''}\n")
-            self.txt.config(state="disabled")
-        except Exception as e:
-            messagebox.showerror("Error", f"詳細取得失敗:\n{e}")
+        if svc_id != self._detail_service_id:
+            self._detail_service_id = svc_id
+            if self._ws:
+                self._ws.close()
+                self._ws = None
+            if websocket is not None:
+                # 接続直後にサーバーが現在状態を push してくる
+                self._ws = WsClient(
+                    self.api.base, svc_id,
+                    on_update=lambda q: self.root.after(0, lambda: self._render_detail(q)),
+                    on_disconnect=lambda: self.root.after(0, self.fetch_detail),
+                )
+        # スナップショット取得済みならネットワークを待たずに描画
+        q = self._queues.get(svc_id)
+        if q is not None:
+            self._render_detail(q)
+        elif self._ws is None:
+            self.fetch_detail()
+
+    def fetch_detail(self):
+        """WebSocket が使えないときの REST フォールバック"""
+        self._ws = None
+        if self._detail_service_id is None:
+            return
+        svc_id = self._detail_service_id
+        run_async(self.root, lambda: self.api.queue_detail(svc_id),
+                  self._render_detail,
+                  lambda e: messagebox.showerror("Error", f"詳細取得失敗:\n{e}"))
+
+    def _render_detail(self, q: Dict[str, Any]):
+        self._queues[q["service_id"]] = q  # ローカルキャッシュも最新化
+        if q.get("service_id") != self._detail_service_id:
+            return  # 選択切替中に届いた古い更新は捨てる
+        self.txt.config(state="normal")
+        self.txt.delete("1.0", "end")
+        self.txt.insert("end", f"{q['service_name']}  待ち: {q['waiting']}人\n\n")
+        for t in q["tickets"]:
+            self.txt.insert("end",
+                            f"#{t['id']:04d} {t['name']:<12} Pos:{t['position']} "
+                            f"{'呼出済' if t['called'] else ''}\n")
+        self.txt.config(state="disabled")
 
     def call_next(self):
         svc_id = self.selected_service_id()
         if svc_id is None:
             messagebox.showinfo("選択", "サービスを選択してください")
             return
-        try:
-            t = self.api.call_next(svc_id)
+
+        def done(t):
             messagebox.showinfo("呼び出し",
                                 f"Ticket #{t['id']}  {t['name']} を呼び出しました")
-            self.show_detail()
+            if self._ws is None:  # 購読中ならサーバー push で詳細は更新される
+                self.fetch_detail()
             self.load_stats()
-        except Exception as e:
-            messagebox.showerror("Error", f"呼び出し失敗:\n{e}")
+
+        run_async(self.root, lambda: self.api.call_next(svc_id), done,
+                  lambda e: messagebox.showerror("Error", f"呼び出し失敗:\n{e}"))
 
     def add_service(self):
         name = self.add_name.get().strip()
@@ -278,13 +423,14 @@ class AdminGUI:
             messagebox.showwarning("入力不足", "サービス名を入力してください")
             return
         desc = self.add_desc.get().strip() or None
-        try:
-            self.api.add_service(name, desc)
+
+        def done(_svc):
             self.add_name.set("")
             self.add_desc.set("")
             self.load_stats()
-        except Exception as e:
-            messagebox.showerror("Error", f"追加失敗:\n{e}")
+
+        run_async(self.root, lambda: self.api.add_service(name, desc), done,
+                  lambda e: messagebox.showerror("Error", f"追加失敗:\n{e}"))
 
 
 # ───────────────────────────────────────────────
@@ -6,6 +6,7 @@ Client_main.py ― 受付システム Tkinter クライアント
 """
 
 import argparse
+import json
 import threading
 import tkinter as tk
 from tkinter import messagebox, ttk
@@ -13,23 +14,80 @@ from typing import Any, Dict, List, Optional
 
 import requests
 
+try:
+    import websocket  # websocket-client（無ければ REST ポーリングにフォールバック）
+except ImportError:
+    websocket = None
+
 API_BASE = "http://localhost:8000"
 
+
+class WsClient:
+    """/ws/queues/{service_id} を購読し、更新をコールバックへ渡す"""
+
+    def __init__(self, base: str, service_id: int, on_update, on_disconnect):
+        ws_base = base.replace("http://", "ws://", 1).replace("https://", "wss://", 1)
+        self.on_update = on_update
+        self.on_disconnect = on_disconnect
+        self.closed = False
+        self.app = websocket.WebSocketApp(
+            f"{ws_base}/ws/queues/{service_id}",
+            on_message=self._on_message,
+            on_error=self._on_closed,
+            on_close=self._on_closed,
+        )
+        threading.Thread(target=self.app.run_forever, daemon=True).start()
+
+    def _on_message(self, _ws, message):
+        try:
+            self.on_update(json.loads(message))
+        except Exception:
+            pass
+
+    def _on_closed(self, _ws, *args):
+        if not self.closed:
+            self.closed = True
+            self.on_disconnect()
+
+    def close(self):
+        self.closed = True
+        try:
+            self.app.close()
+        except Exception:
+            pass
+
 class ApiClient:
     def __init__(self, base: str = API_BASE):
         self.base = base.rstrip("/")
+        # keep-alive 接続を使い回す（ポーリングごとの TCP 接続確立を省く）
+        self.s = requests.Session()
+        self.s.headers.update({"Connection": "keep-alive"})
+        adapter = requests.adapters.HTTPAdapter(pool_connections=4, pool_maxsize=8)
+        self.s.mount("http://", adapter)
+        # /services の ETag（304 なら前回ボディを使い回す）
+        self._services_etag: Optional[str] = None
+        self._services_body: Optional[List[Dict[str, Any]]] = None
 
     def get_services(self):
-        return requests.get(self.base + "/services", timeout=5).json()
+        headers = {}
+        if self._services_etag:
+            headers["If-None-Match"] = self._services_etag
+        r = self.s.get(self.base + "/services", timeout=5, headers=headers)
+        if r.status_code == 304:
+            return self._services_body
+        r.raise_for_status()
+        self._services_etag = r.headers.get("ETag")
+        self._services_body = r.json()
+        return self._services_body
 
     def register_ticket(self, name: str, service_id: int):
-        r = requests.post(self.base + "/tickets",
-                          json={"name": name, "service_id": service_id}, timeout=5)
+        r = self.s.post(self.base + "/tickets",
+                        json={"name": name, "service_id": service_id}, timeout=5)
         r.raise_for_status()
         return r.json()
 
     def queue_detail(self, service_id: int):
-        r = requests.get(self.base + f"/queues/{service_id}", timeout=5)
+        r = self.s.get(self.base + f"/queues/{service_id}", timeout=5)
         r.raise_for_status()
         return r.json()
 
@@ -40,6 +98,7 @@ class ClientGUI:
         self.root.title("受付 (Client)")
         self.ticket_ids: List[int] = []
         self.current_service_id: Optional[int] = None
+        self._called_seen: set[int] = set()
 
         # 上部フレーム：全体情報
         frm_top = ttk.Frame(root, padding=10)
@@ -85,12 +144,18 @@ class ClientGUI:
         self.lst_called = tk.Listbox(frm_called_box, height=6, font=("Helvetica", 18))
         self.lst_called.pack(fill="both", expand=True)
 
-        self.refresh_services()
         self._queue_info_job = None
+        self._ws: Optional[WsClient] = None
+        self._last_services_sig: Optional[tuple] = None
+        self.refresh_services()
 
     def refresh_services(self):
         try:
             svcs = self.api.get_services()
+            sig = tuple((s["id"], s["name"]) for s in svcs)
+            if sig == self._last_services_sig:
+                return  # 変化がなければ Combobox を作り直さず購読も維持する
+            self._last_services_sig = sig
             self.svc_dict = {s["name"]: s["id"] for s in svcs}
             self.cmb["values"] = list(self.svc_dict.keys())
             if svcs:
@@ -104,27 +169,67 @@ class ClientGUI:
         svc_name = self.cmb_var.get()
         if svc_name not in self.svc_dict:
             return
-        self.current_service_id = self.svc_dict[svc_name]
-        self.poll_queue_info()
+        service_id = self.svc_dict[svc_name]
+        if service_id != self.current_service_id:
+            # 別サービスの呼び出し履歴は持ち越さない
+            self._called_seen.clear()
+            self.lst_called.delete(0, "end")
+            self.called_var.set("")
+        self.current_service_id = service_id
+        self._subscribe()
+
+    def _subscribe(self):
+        """WebSocket 購読に切り替える。使えない場合は REST ポーリング"""
+        if self._ws:
+            self._ws.close()
+            self._ws = None
+        if self._queue_info_job:
+            self.root.after_cancel(self._queue_info_job)
+            self._queue_info_job = None
+        if websocket is None:
+            self.poll_queue_info()
+            return
+        self._ws = WsClient(
+            self.api.base, self.current_service_id,
+            on_update=lambda q: self.root.after(0, lambda: self._apply_queue(q)),
+            on_disconnect=lambda: self.root.after(0, self._on_ws_disconnect),
+        )
+
+    def _on_ws_disconnect(self):
+        # 切断されたら REST ポーリングにフォールバック
+        self._ws = None
+        if self._queue_info_job is None:
+            self.poll_queue_info()
+
+    def _apply_queue(self, q: Dict[str, Any]):
+        if q.get("service_id") != self.current_service_id:
+            return  # サービス切替中に届いた古い更新は捨てる
+        self.waiting_var.set(str(q["waiting"]))
+
+        # 呼び出された人一覧
+        called = [t for t in q["tickets"] if t["called"]]
+        self.called_var.set(
+            " / ".join(f"{t['id']}:{t['name']}" for t in called[-3:]))  # 最新3名だけテキストで
+        # 表示済みのチケットは挿入し直さない（毎回の全再描画を避ける）
+        for t in called:
+            if t["id"] not in self._called_seen:
+                self._called_seen.add(t["id"])
+                self.lst_called.insert("end", f"{t['id']}: {t['name']}")
+        # 長時間運用でも Listbox を肥大化させない
+        while self.lst_called.size() > 50:
+            self.lst_called.delete(0)
 
     def poll_queue_info(self):
-        if not self.current_service_id:
+        if not self.current_service_id or self._ws:
             return
         try:
             q = self.api.queue_detail(self.current_service_id)
-            self.waiting_var.set(str(q["waiting"]))
-
-            # 呼び出された人一覧
-            called_list = [f"{t['id']}:{t['name']}" for t in q["tickets"] if t["called"]]
-            self.called_var.set(" / ".join(called_list[-3:]))  # 最新3名だけテキストで
-            self.lst_called.delete(0, "end")
-            for t in q["tickets"]:
-                if t["called"]:
-                    self.lst_called.insert("end", f"{t['id']}: {t['name']}")
-        except Exception as e:
+            self._apply_queue(q)
+        except Exception:
             self.waiting_var.set("-")
             self.called_var.set("")
             self.lst_called.delete(0, "end")
+            self._called_seen.clear()  # 復帰時に呼び出し済み一覧を再構築する
         # 3秒ごとに更新
         self._queue_info_job = self.root.after(3000, self.poll_queue_info)
 
@@ -3,18 +3,25 @@
 """
 Server_main.py  ―  Culture-Fest 受付システム 2025
 ---------------------------------------------------
-▶ 依存:  pip install fastapi uvicorn sqlmodel
+▶ 依存:  pip install fastapi "uvicorn[standard]" sqlmodel orjson
 ▶ 起動:  python3 Server_main.py
 """
 
+import asyncio
+import socket
+import time
+import zlib
+
 from datetime import datetime, timezone
-from typing import List, Optional, Generator
+from typing import Any, Callable, Dict, List, Optional, Generator
 
+import orjson
 from fastapi import (
-    FastAPI, HTTPException, Depends,
+    FastAPI, HTTPException, Depends, Request, Response,
     WebSocket, WebSocketDisconnect, Header, status
 )
 from pydantic import BaseModel
+from sqlalchemy import Index, event, func, text
 from sqlmodel import (
     Field, SQLModel, Session, select, create_engine
 )
@@ -23,24 +30,53 @@ from sqlmodel import (
 # DB 初期化
 # ───────────────────────────────────────────────
 DATABASE_URL = "sqlite:///./queue.db"
-engine = create_engine(DATABASE_URL, echo=False)
+engine = create_engine(
+    DATABASE_URL, echo=False,
+    connect_args={"check_same_thread": False},
+    pool_size=10, max_overflow=20,
+)
+
+
+@event.listens_for(engine, "connect")
+def _set_sqlite_pragma(dbapi_conn, _record) -> None:
+    # WAL なら書き込みコミット中も読み取りをブロックしない（ポーリング主体の負荷向け）
+    cur = dbapi_conn.cursor()
+    cur.execute("PRAGMA journal_mode=WAL")
+    cur.execute("PRAGMA synchronous=NORMAL")
+    cur.execute("PRAGMA temp_store=MEMORY")
+    cur.close()
 
 # ───────────────────────────────────────────────
 # テーブル定義
 # ───────────────────────────────────────────────
+# created_at は DB 側で採番する（INSERT ごとの datetime 生成・転送を省く）。
+# CURRENT_TIMESTAMP は秒精度で FIFO 順が崩れるためミリ秒精度の式を使い、
+# SQLAlchemy が bind する 6 桁小数と文字列比較できるよう '000' を足して揃える
+_CREATED_AT_DEFAULT = text("(STRFTIME('%Y-%m-%d %H:%M:%f', 'now') || '000')")
+
+
 class Service(SQLModel, table=True):
     id: Optional[int] = Field(default=None, primary_key=True)
     name: str = Field(index=True, unique=True, nullable=False)
     description: Optional[str] = None
-    created_at: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
+    created_at: Optional[datetime] = Field(
+        default=None, nullable=False,
+        sa_column_kwargs={"server_default": _CREATED_AT_DEFAULT})
 
 
 class Ticket(SQLModel, table=True):
+    # 待ち人数カウント（service_id, called, created_at の絞り込み）を index-only にする
+    __table_args__ = (
+        Index("ix_ticket_svc_called_created", "service_id", "called", "created_at"),
+    )
+
     id: Optional[int] = Field(default=None, primary_key=True)
     name: str = Field(index=True, nullable=False)
     service_id: int = Field(foreign_key="service.id")
     called: bool = Field(default=False)
-    created_at: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
+    created_at: Optional[datetime] = Field(
+        default=None, nullable=False,
+        sa_column_kwargs={"server_default": _CREATED_AT_DEFAULT})
     called_at: Optional[datetime] = None
 
 # ───────────────────────────────────────────────
@@ -78,11 +114,17 @@ class QueueSummary(BaseModel):
     service_name: str
     waiting: int
 
+
+class SnapshotRead(BaseModel):
+    services: List[QueueSummary]
+    queues: Dict[int, QueueRead]
+
 # ───────────────────────────────────────────────
 # 依存
 # ───────────────────────────────────────────────
 def get_session() -> Generator[Session, None, None]:
-    with Session(engine) as session:
+    # リクエストごとの短命セッションなので commit 後の expire（再 SELECT の元）は不要
+    with Session(engine, expire_on_commit=False) as session:
         yield session
 
 
@@ -93,6 +135,48 @@ def verify_admin(x_api_key: str = Header(...)) -> None:
     if x_api_key != ADMIN_API_KEY:
         raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Invalid API key")
 
+# ───────────────────────────────────────────────
+# 短 TTL キャッシュ（同時ポーリングを TTL 窓ごと 1 クエリにまとめる）
+# ───────────────────────────────────────────────
+_cache: dict[tuple, tuple[float, Any]] = {}
+
+
+def _cached(key: tuple, max_age: float, producer: Callable[[], Any]) -> Any:
+    now = time.monotonic()
+    hit = _cache.get(key)
+    if hit and now - hit[0] < max_age:
+        return hit[1]
+    value = producer()
+    _cache[key] = (now, value)
+    return value
+
+
+def _invalidate_queue_cache(service_id: int) -> None:
+    """書き込み後に呼び、該当キューと統計のキャッシュを破棄する"""
+    _cache.pop(("queue", service_id), None)
+    _cache.pop(("stats",), None)
+
+
+# Service 行はイベント中ほぼ不変（追加のみ）なので id 引きをプロセス内に持つ
+_svc_cache: Dict[int, "Service"] = {}
+
+
+def _reload_service_cache() -> None:
+    with Session(engine) as session:
+        _svc_cache.clear()
+        for svc in session.exec(select(Service)).all():
+            _svc_cache[svc.id] = svc
+
+
+def _get_service_cached(service_id: int, session: Session) -> Optional["Service"]:
+    svc = _svc_cache.get(service_id)
+    if svc is None:
+        # 他プロセスからの追加などの取りこぼしは DB へフォールバック
+        svc = session.get(Service, service_id)
+        if svc is not None:
+            _svc_cache[svc.id] = svc
+    return svc
+
 # ───────────────────────────────────────────────
 # FastAPI 本体
 # ───────────────────────────────────────────────
@@ -103,42 +187,95 @@ app = FastAPI(
 )
 
 
+_loop: Optional[asyncio.AbstractEventLoop] = None
+
+
+def _migrate_schema() -> None:
+    """既存 DB への軽量マイグレーション。
+
+    create_all(checkfirst) は既存テーブルを見直さないため、旧スキーマの
+    queue.db では created_at の server_default も複合索引も付かないまま
+    INSERT が NOT NULL 違反で落ちる。該当テーブルは正しい定義で作り直して
+    データをコピーする（SQLite は列の default を ALTER できない）。
+    """
+    with engine.begin() as conn:
+        for name in ("service", "ticket"):
+            info = conn.exec_driver_sql(f'PRAGMA table_info("{name}")').fetchall()
+            if not info:
+                continue  # テーブルが無ければ create_all が正しい定義で作る
+            defaults = {row[1]: row[4] for row in info}
+            if defaults.get("created_at") is not None:
+                continue  # server_default 付き＝移行済み
+            cols = ", ".join(f'"{row[1]}"' for row in info)
+            conn.exec_driver_sql(f'ALTER TABLE "{name}" RENAME TO "{name}__old"')
+            # 旧テーブルに付いたままの索引は新テーブルと名前が衝突するので外す
+            old_indexes = conn.exec_driver_sql(
+                "SELECT name FROM sqlite_master WHERE type='index' "
+                "AND tbl_name=? AND name NOT LIKE 'sqlite_%'",
+                (f"{name}__old",)).fetchall()
+            for (index_name,) in old_indexes:
+                conn.exec_driver_sql(f'DROP INDEX "{index_name}"')
+            SQLModel.metadata.tables[name].create(conn)
+            conn.exec_driver_sql(
+                f'INSERT INTO "{name}" ({cols}) SELECT {cols} FROM "{name}__old"')
+            conn.exec_driver_sql(f'DROP TABLE "{name}__old"')
+        # 複合索引だけが無い世代の DB（移行不要でもここで追い付かせる）
+        if conn.exec_driver_sql("PRAGMA table_info(\"ticket\")").fetchall():
+            conn.exec_driver_sql(
+                "CREATE INDEX IF NOT EXISTS ix_ticket_svc_called_created "
+                "ON ticket (service_id, called, created_at)")
+
+
 @app.on_event("startup")
 def on_startup() -> None:
+    global _loop
+    _loop = asyncio.get_event_loop()
+    _migrate_schema()
     SQLModel.metadata.create_all(engine)
+    _reload_service_cache()
 
 # ───────────────────────────────────────────────
 # サービス
 # ───────────────────────────────────────────────
 @app.post("/services", response_model=Service, status_code=status.HTTP_201_CREATED)
 def create_service(data: ServiceCreate, session: Session = Depends(get_session)):
-    if session.exec(select(Service).where(Service.name == data.name)).first():
+    # 存在確認だけなので行全体を ORM 化せず id 列のみ引く
+    if session.exec(select(Service.id).where(Service.name == data.name)).first():
         raise HTTPException(400, f"Service '{data.name}' already exists")
     svc = Service.model_validate(data)          # from_orm は非推奨
     session.add(svc)
-    session.commit()
-    session.refresh(svc)
+    session.commit()  # id と created_at は INSERT..RETURNING で埋まる
+    _svc_cache[svc.id] = svc
+    _cache.pop(("stats",), None)
     return svc
 
 
 @app.get("/services", response_model=List[Service])
-def list_services(session: Session = Depends(get_session)):
-    return session.exec(select(Service).order_by(Service.id)).all()
+def list_services(request: Request, response: Response,
+                  session: Session = Depends(get_session)):
+    services = session.exec(select(Service).order_by(Service.id)).all()
+    # サービスは追加のみなので件数＋最大 id で内容が一意に決まる
+    etag = f'W/"{len(services)}-{services[-1].id if services else 0}"'
+    if request.headers.get("if-none-match") == etag:
+        return Response(status_code=status.HTTP_304_NOT_MODIFIED)
+    response.headers["ETag"] = etag
+    return services
 
 # ───────────────────────────────────────────────
 # チケット
 # ───────────────────────────────────────────────
 @app.post("/tickets", response_model=TicketRead, status_code=status.HTTP_201_CREATED)
 def register_ticket(data: TicketCreate, session: Session = Depends(get_session)):
-    service = session.get(Service, data.service_id)
+    service = _get_service_cached(data.service_id, session)
     if not service:
         raise HTTPException(404, "Service not found")
 
     ticket = Ticket(name=data.name, service_id=service.id)
     session.add(ticket)
-    session.commit()
-    session.refresh(ticket)
+    session.commit()  # id と created_at は INSERT..RETURNING で埋まる
     pos = _position_in_queue(ticket, session)
+    _invalidate_queue_cache(service.id)
+    _notify_queue_update(service.id)
     return _ticket_to_read(ticket, position=pos)
 
 
@@ -158,38 +295,49 @@ def cancel_ticket(ticket_id: int, session: Session = Depends(get_session)):
         raise HTTPException(404, "Ticket not found")
     if ticket.called:
         raise HTTPException(400, "Already called; cannot cancel")
+    service_id = ticket.service_id
     session.delete(ticket)
     session.commit()
+    _invalidate_queue_cache(service_id)
+    _notify_queue_update(service_id)
 
 # ───────────────────────────────────────────────
 # キュー詳細
 # ───────────────────────────────────────────────
 @app.get("/queues/{service_id}", response_model=QueueRead)
-def queue_detail(service_id: int, session: Session = Depends(get_session)):
-    service = session.get(Service, service_id)
-    if not service:
-        raise HTTPException(404, "Service not found")
+def queue_detail(service_id: int, session: Session = Depends(get_session),
+                 max_age: int = 1, refresh: bool = False):
+    if refresh:
+        _cache.pop(("queue", service_id), None)
+
+    def produce() -> QueueRead:
+        service = _get_service_cached(service_id, session)
+        if not service:
+            raise HTTPException(404, "Service not found")
+
+        # called==Trueも含めて、全チケットを返す（待機中が先頭に並ぶよう並べ替え）
+        all_tickets = session.exec(
+            select(Ticket)
+            .where(Ticket.service_id == service_id)
+            .order_by(Ticket.called, Ticket.created_at, Ticket.id)
+        ).all()
+        return _build_queue_read(service, all_tickets)
 
-    # called==Trueも含めて、全チケットを古い順で返す
-    all_tickets = session.exec(
-        select(Ticket)
-        .where(Ticket.service_id == service_id)
-        .order_by(Ticket.created_at)
-    ).all()
+    return _cached(("queue", service_id), max_age, produce)
 
-    waiting = len([t for t in all_tickets if not t.called])
 
-    read_list = [
-        _ticket_to_read(t, position=(i + 1) if not t.called else 0)
-        for i, t in enumerate([t for t in all_tickets if not t.called])
-    ]
-    # 全チケット分を返す
-    tickets_list = []
+def _build_queue_read(service: Service, tickets: List[Ticket]) -> QueueRead:
+    """1 回の走査で position と待ち人数を同時に求める"""
+    tickets_list: List[TicketRead] = []
     idx = 1
-    for t in all_tickets:
-        pos = idx if not t.called else 0
+    waiting = 0
+    for t in tickets:
         if not t.called:
+            pos = idx
             idx += 1
+            waiting += 1
+        else:
+            pos = 0
         tickets_list.append(_ticket_to_read(t, position=pos))
     return QueueRead(
         service_id=service.id,
@@ -208,7 +356,7 @@ def call_next(service_id: int, session: Session = Depends(get_session)):
     ticket = session.exec(
         select(Ticket)
         .where(Ticket.service_id == service_id, Ticket.called == False)
-        .order_by(Ticket.created_at)
+        .order_by(Ticket.created_at, Ticket.id)
         .limit(1)
     ).first()
     if not ticket:
@@ -217,42 +365,106 @@ def call_next(service_id: int, session: Session = Depends(get_session)):
     ticket.called = True
     ticket.called_at = datetime.now(timezone.utc)
     session.add(ticket)
-    session.commit()
-    session.refresh(ticket)
+    session.commit()  # 返す値はすべて Python 側で設定済みなので再読込しない
+    _invalidate_queue_cache(service_id)
+    _notify_queue_update(service_id)
     return _ticket_to_read(ticket, position=0)
 
 # ───────────────────────────────────────────────
 # 待ち人数サマリ（修正版）
 # ───────────────────────────────────────────────
 @app.get("/stats", response_model=List[QueueSummary])
-def stats(session: Session = Depends(get_session)):
-    services = session.exec(select(Service)).all()
-    summaries: List[QueueSummary] = []
-    for svc in services:
-        waiting_rows = session.exec(
-            select(Ticket).where(
-                Ticket.service_id == svc.id,
-                Ticket.called == False
-            )
+def stats(request: Request, response: Response,
+          session: Session = Depends(get_session),
+          max_age: int = 2, refresh: bool = False):
+    if refresh:
+        _cache.pop(("stats",), None)
+
+    def produce() -> List[QueueSummary]:
+        # サービスごとの SELECT を繰り返さず、1 クエリの GROUP BY で集計する
+        rows = session.exec(
+            select(Service.id, Service.name, func.count(Ticket.id))
+            .join(Ticket,
+                  (Ticket.service_id == Service.id) & (Ticket.called == False),
+                  isouter=True)
+            .group_by(Service.id, Service.name)
+            .order_by(Service.id)
         ).all()
-        summaries.append(
-            QueueSummary(
-                service_id=svc.id,
-                service_name=svc.name,
-                waiting=len(waiting_rows)
-            )
-        )
+        return [
+            QueueSummary(service_id=r[0], service_name=r[1], waiting=r[2])
+            for r in rows
+        ]
+
+    summaries = _cached(("stats",), max_age, produce)
+    sig = ",".join(f"{s.service_id}:{s.service_name}:{s.waiting}" for s in summaries)
+    etag = f'W/"{zlib.crc32(sig.encode()):08x}"'
+    if request.headers.get("if-none-match") == etag:
+        return Response(status_code=status.HTTP_304_NOT_MODIFIED)
+    response.headers["ETag"] = etag
     return summaries
 
+# ───────────────────────────────────────────────
+# 管理画面用スナップショット（統計＋全キュー詳細を 1 往復で）
+# ───────────────────────────────────────────────
+@app.get("/admin/snapshot", response_model=SnapshotRead,
+         dependencies=[Depends(verify_admin)])
+def admin_snapshot(session: Session = Depends(get_session)):
+    services = session.exec(select(Service).order_by(Service.id)).all()
+    tickets_by_svc: Dict[int, List[Ticket]] = {svc.id: [] for svc in services}
+    if services:
+        # サービスごとに SELECT せず、全チケットを 1 クエリで取って振り分ける
+        all_tickets = session.exec(
+            select(Ticket)
+            .where(Ticket.service_id.in_(tickets_by_svc))  # type: ignore[union-attr]
+            .order_by(Ticket.called, Ticket.created_at, Ticket.id)
+        ).all()
+        for t in all_tickets:
+            tickets_by_svc[t.service_id].append(t)
+
+    queues = {
+        svc.id: _build_queue_read(svc, tickets_by_svc[svc.id])
+        for svc in services
+    }
+    summaries = [
+        QueueSummary(service_id=q.service_id, service_name=q.service_name,
+                     waiting=q.waiting)
+        for q in queues.values()
+    ]
+    return SnapshotRead(services=summaries, queues=queues)
+
 # ───────────────────────────────────────────────
 # WebSocket（任意購読）
 # ───────────────────────────────────────────────
 subscribers: dict[int, list[WebSocket]] = {}
 
 
+def _set_tcp_nodelay(websocket: WebSocket) -> bool:
+    """Nagle 遅延（最大 40ms のバッファリング）を無効化する。
+
+    ASGI サーバーによって生ソケットの在り処が違うので、見つからなければ
+    何もしない（UNIX ソケットやテスト用トランスポートでも安全）。
+    """
+    try:
+        transport = websocket.scope.get("transport")
+        if transport is None:
+            transport = getattr(websocket, "transport", None)
+        if transport is None:
+            # uvicorn では ASGI receive コールバックの先にプロトコルがいる
+            protocol = getattr(websocket._receive, "__self__", None)
+            transport = getattr(protocol, "transport", None)
+        sock = transport.get_extra_info("socket") if transport else None
+        if sock is None:
+            return False
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        return True
+    except (AttributeError, OSError):
+        return False
+
+
 @app.websocket("/ws/queues/{service_id}")
 async def queue_ws(websocket: WebSocket, service_id: int):
     await websocket.accept()
+    _set_tcp_nodelay(websocket)
     subscribers.setdefault(service_id, []).append(websocket)
     try:
         await _push_queue_update(service_id)
@@ -262,16 +474,60 @@ async def queue_ws(websocket: WebSocket, service_id: int):
         subscribers[service_id].remove(websocket)
 
 
+def _build_queue_payload(service_id: int) -> Optional[bytes]:
+    """購読者向けに QueueRead を組み立て、シリアライズ済み JSON で返す"""
+    with Session(engine) as session:
+        try:
+            # 書き込み直後の配信なので TTL キャッシュは信用しない。
+            # （invalidate 直後に読み取りが古い値を書き戻していても、
+            # max_age=0 なら再計算してキャッシュも正しい値に上書きされる）
+            read = queue_detail(service_id, session, max_age=0)
+        except HTTPException:
+            return None  # サービス削除などで見つからなければ配信しない
+    return orjson.dumps(read.model_dump(mode="json"))
+
+
 async def _push_queue_update(service_id: int):
-    if not subscribers.get(service_id):
+    subs = subscribers.get(service_id)
+    if not subs:
         return
-    async with Session(engine) as session:
-        data = queue_detail(service_id, session)  # type: ignore[arg-type]
-    for ws in list(subscribers[service_id]):
-        try:
-            await ws.send_json(data.model_dump())
-        except RuntimeError:
-            subscribers[service_id].remove(ws)
+    # DB アクセスとシリアライズはワーカースレッドへ逃がし、イベントループを塞がない
+    payload = await asyncio.to_thread(_build_queue_payload, service_id)
+    if payload is None:
+        return
+    # エンコードは 1 回だけ、送信は全購読者へ並行に
+    targets = list(subs)
+    results = await asyncio.gather(
+        *(ws.send_bytes(payload) for ws in targets), return_exceptions=True)
+    for ws, res in zip(targets, results):
+        if isinstance(res, Exception) and ws in subs:
+            subs.remove(ws)
+
+
+# サービスごとの配信予約。予約済みの間に届いた更新は 1 回の push にまとまる
+_pending: dict[int, asyncio.Task] = {}
+_PUSH_DEBOUNCE = 0.1  # 秒
+
+
+async def _delayed_push(service_id: int) -> None:
+    await asyncio.sleep(_PUSH_DEBOUNCE)
+    _pending.pop(service_id, None)
+    await _push_queue_update(service_id)
+
+
+def _notify_queue_update(service_id: int) -> None:
+    """同期エンドポイント（ワーカースレッド）から購読者への push を予約する"""
+    if _loop is None or not subscribers.get(service_id):
+        return
+    if service_id in _pending:
+        return  # 予約済み：バースト中の連続更新をまとめる
+
+    def schedule() -> None:
+        # _pending の判定と登録はループスレッド上で行い、競合を避ける
+        if service_id not in _pending:
+            _pending[service_id] = _loop.create_task(_delayed_push(service_id))
+
+    _loop.call_soon_threadsafe(schedule)
 
 # ───────────────────────────────────────────────
 # 内部ユーティリティ（修正版）
@@ -280,14 +536,17 @@ def _position_in_queue(ticket: Ticket, session: Session) -> int:
     """待機中なら 1 以上、呼出済なら 0"""
     if ticket.called:
         return 0
-    earlier_rows = session.exec(
-        select(Ticket).where(
+    # created_at はミリ秒精度なので同時登録で並ぶことがある。id で順序を
+    # 一意にし、queue_detail / call_next の並びと必ず一致させる
+    earlier = session.exec(
+        select(func.count()).select_from(Ticket).where(
             Ticket.service_id == ticket.service_id,
             Ticket.called == False,
-            Ticket.created_at < ticket.created_at
+            (Ticket.created_at < ticket.created_at)
+            | ((Ticket.created_at == ticket.created_at) & (Ticket.id < ticket.id))
         )
-    ).all()
-    return len(earlier_rows) + 1
+    ).one()
+    return earlier + 1
 
 
 def _ticket_to_read(ticket: Ticket, position: int) -> TicketRead:
@@ -306,4 +565,8 @@ def _ticket_to_read(ticket: Ticket, position: int) -> TicketRead:
 # ───────────────────────────────────────────────
 if __name__ == "__main__":
     import uvicorn
-    uvicorn.run(app, host="0.0.0.0", port=8000, reload=False)
\ No newline at end of file
+    # uvloop + httptools でイベントループと HTTP パースを C 実装にする。
+    # workers は 1 のまま：subscribers / TTL キャッシュはプロセス内共有なので、
+    # 複数ワーカーに分かれると別ワーカー経由の更新が購読者へ届かなくなる
+    uvicorn.run(app, host="0.0.0.0", port=8000,
+                loop="uvloop", http="httptools", reload=False)
\ No newline at end of file